@@ -4,55 +4,159 @@ Provides an interface on the xcel version of the google spreadsheet.
 
 from __future__ import print_function
 
+import io
+import os
 import sys
 import re
-from operator import attrgetter
-from collections import namedtuple
+import tempfile
+import warnings
+from operator import itemgetter
+from collections import namedtuple, defaultdict
 from functools import wraps
 from string import maketrans
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 import openpyxl
 MODEL = 'HadGEM3' # temporary hardcode - should be an option
 
-def open(fname, filt=True):
-    spsh = openpyxl.load_workbook(fname, read_only=True)
+def open(fname, filt=True, cache=False):
+    """
+    Return the requests in the xcel file fname.
+
+    If cache is True the parsed sheet is kept in a pickle alongside fname
+    and reused while it is newer than fname.
+    """
+    if cache:
+        spsh = _CachedWorkbook(fname)
+    else:
+        spsh = _load_workbook(fname)
     
     return RequestWithMappings(spsh, filt)
 
-STASH_RANGE_PATTERN = re.compile(r'm01s(\d\d)i(\d\d\d)\:i(\d\d\d)')
-STASH_PATTERN = re.compile(r'm01s(\d\d)i(\d\d\d)')
+def _load_workbook(fname):
+    return openpyxl.load_workbook(fname, read_only=True)
+
+class _CachedWorkbook(object):
+    """
+    Workbook whose sheets are read from (or saved to) a pickle per sheet.
+
+    Each pickle records the workbook's mtime and size, and is only reused
+    while both still match.
+    """
+    def __init__(self, fname):
+        self._fname = fname
+
+    def get_sheet_by_name(self, name):
+        cache = '{}.{}.pkl'.format(self._fname, name)
+        stat = os.stat(self._fname)
+        stamp = (stat.st_mtime, stat.st_size)
+        cached = None
+        if os.path.exists(cache):
+            cached = self._read_cache(cache, stamp)
+        if cached is None:
+            sheet = _load_workbook(self._fname).get_sheet_by_name(name)
+            cached = (list(sheet.iter_rows(values_only=True)),
+                      (sheet.max_row, sheet.max_column))
+            self._write_cache(cache, (stamp,) + cached)
+        rows, dims = cached
+        return _CachedSheet(rows, dims)
+
+    @staticmethod
+    def _read_cache(cache, stamp):
+        """
+        Return the cached (rows, dims), or None if the cache is unreadable
+        or was made from a different version of the workbook.
+        """
+        try:
+            with io.open(cache, 'rb') as fh:
+                cache_stamp, rows, dims = pickle.load(fh)
+        except Exception as err:  # truncated or corrupt: treat as a miss
+            warnings.warn("ignoring unreadable cache {}: {!r}".format(cache, err))
+            return None
+        if cache_stamp != stamp:
+            return None
+        return rows, dims
+
+    @staticmethod
+    def _write_cache(cache, cached):
+        """Write cached to a temporary file then rename it over cache."""
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=os.path.basename(cache) + '.',
+                                       dir=os.path.dirname(cache) or '.')
+            with io.open(fd, 'wb') as fh:
+                pickle.dump(cached, fh, pickle.HIGHEST_PROTOCOL)
+            # mkstemp creates the file 0600; give it the usual permissions
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            os.rename(tmp, cache)
+        except (IOError, OSError) as err:
+            warnings.warn("unable to cache sheet: {}".format(err))
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+class _CachedSheet(object):
+    def __init__(self, rows, dims):
+        self._rows = rows
+        self.max_row, self.max_column = dims
+
+    def iter_rows(self, values_only=True):
+        return iter(self._rows)
+
+STASH_PATTERN = re.compile(r'm01s(\d\d)i(\d\d\d)(?::i(\d\d\d))?')
 STASH_FMT = "m01s{0:02d}i{1:03d}"
+_GROUP_PATTERN = re.compile(r'[^",\s]+')
+_COMMENT_PATTERN = re.compile(r'\(comment:.*\)')
+_TIME_PATTERN = re.compile(r'time\d+')
+
+def canonical_cell_methods(value):
+    """
+    Return value as a string with any comment elided.
+
+    >>> canonical_cell_methods('area: mean (comment: land only)')
+    'area: mean (comment:..)'
+    """
+    return _COMMENT_PATTERN.sub('(comment:..)', str(value))
 
 def stashlist_from_mapping_entry(entry):
     """
     Strip out a list of the stash codes involved in a mapping.
+
+    Ranges of the form m01sXXiYYY:iZZZ are expanded.
+
+    >>> stashlist_from_mapping_entry('m01s02i003:i005 + m01s01i001')
+    ['m01s01i001', 'm01s02i003', 'm01s02i004', 'm01s02i005']
     """
     retval = []
-	
+
     if entry is None:
         return None
-	
+
     try:
-        range_patterns = STASH_RANGE_PATTERN.findall(entry)
+        matches = STASH_PATTERN.findall(entry)
     except TypeError:
         warnings.warn("ignoring entry %s"%entry)
         return None
-	
-    if range_patterns is not None:
-        for j in range_patterns:
-            section, item1, item2 = [int(i) for i in j]
-            retval += [STASH_FMT.format(section, i) for i in range(item1, item2 + 1)]
-	
-    single_patterns = STASH_PATTERN.findall(entry)
-    if single_patterns is not None:
-        for j in single_patterns:
-            section, item = [int(i) for i in j]
-            retval.append(STASH_FMT.format(section, item))
-	   
+
+    for section, item1, item2 in matches:
+        section, item1 = int(section), int(item1)
+        if item2:
+            retval += [STASH_FMT.format(section, i) for i in range(item1, int(item2) + 1)]
+        else:
+            retval.append(STASH_FMT.format(section, item1))
+
     # remove duplicates and sort
-    retval = sorted(list(set(retval)))
+    retval = sorted(set(retval))
     return retval
 
+_ATTR_TABLE = maketrans(' :', '__')
+_ATTR_DELETE = '()\"\''
+
 def _to_attr(value):
     """
     Return a value as in a form suitable for use as attribute.
@@ -66,8 +170,56 @@ def _to_attr(value):
     >>> _to_attr("replace:colons")
     'replace_colons'
     """
-    table = maketrans(' :', '__')
-    return value.lower().translate(table, '()\"\'')
+    return value.lower().translate(_ATTR_TABLE, _ATTR_DELETE)
+
+def _note_value(notes, key):
+    """
+    Return the text between key and the next colon on the same line of notes.
+
+    >>> _note_value('MO_priority:1:', 'MO_priority:')
+    '1'
+
+    >>> _note_value('MO_priority:1', 'MO_priority:') is None
+    True
+    """
+    start = notes.find(key)
+    while start >= 0:
+        start += len(key)
+        end = notes.find(':', start)
+        if end < 0:
+            return None
+        value = notes[start:end]
+        if '\n' not in value:
+            return value
+        start = notes.find(key, start)
+    return None
+
+class cached_property(object):
+    """
+    Decorator for a property whose value is computed once per instance.
+
+    The result is stored in the instance __dict__, which then shadows the
+    descriptor on later lookups.
+
+    >>> class Thing(object):
+    ...     calls = 0
+    ...     @cached_property
+    ...     def value(self):
+    ...         Thing.calls += 1
+    ...         return 42
+    >>> thing = Thing()
+    >>> thing.value, thing.value, Thing.calls
+    (42, 42, 1)
+    """
+    def __init__(self, func):
+        self._func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        result = instance.__dict__[self._func.__name__] = self._func(instance)
+        return result
 
 _TITLES = ['cmor_label', 'miptable', 
            'cell_methods', 'dimension',
@@ -83,7 +235,7 @@ _TITLES = ['cmor_label', 'miptable',
            "Ticket", 
            "last_update", "title", "positive"]
 
-_FIELDS =  map(_to_attr, _TITLES)
+_FIELDS = tuple(_to_attr(title) for title in _TITLES)
 
 class Request(namedtuple('Request', _FIELDS)):
     """
@@ -96,7 +248,7 @@ class Request(namedtuple('Request', _FIELDS)):
     
     To help set up test data for examples we need a small function:
     >>> def new_sample(): 
-    ...     result =  [None for i in range(18)]
+    ...     result = [None for i in range(len(_FIELDS))]
     ...     result[3] = 'longitude'
     ...     return result
 
@@ -144,6 +296,14 @@ class Request(namedtuple('Request', _FIELDS)):
     >>> a.stash_codes
     []
 
+    Non-text mappings are ignored with a warning
+    >>> sample[9] = 1026
+    >>> sample[3] = None
+    >>> a = Request(*sample)
+    >>> a.stash_codes
+    []
+    >>> sample[3] = 'longitude'
+
     A mapping with a HadGEM3 specific mapping should return it
     >>> sample[9] = 'm01s19i001'
     >>> sample[11] = 'HadGEM3_variable_mapping:veg(m01s03i317,m01s00i505,vegClass="bareSoil"):notes:'
@@ -235,35 +395,49 @@ class Request(namedtuple('Request', _FIELDS)):
     >>> a.priort
     1
 
+    For spotting moved variables, canonical forms ignore comments in the
+    cell methods, numbered time dimensions and point frequencies
+    >>> sample = new_sample()
+    >>> sample[2] = 'area: mean time: mean (comment: land only)'
+    >>> sample[3] = 'time1 longitude latitude'
+    >>> sample[7] = '3hrPt'
+    >>> a = Request(*sample)
+    >>> a.canon_cell_methods
+    'area: mean time: mean (comment:..)'
+    >>> a.canon_dims
+    ('latitude', 'longitude', 'time')
+    >>> a.canon_frequency
+    '3hr'
+
     """
     _MODEL_LEVELS = 'alev' # (this may need extending)
     _OROG_STASH = 'm01s00i033'
-    _HADGEM3 = re.compile('HadGEM3_variable_mapping:(.*?):')
-    _MO_PRIORITY = re.compile('MO_priority:(.*?):')
+    _HADGEM3 = 'HadGEM3_variable_mapping:'
+    _MO_PRIORITY = 'MO_priority:'
 
     @property
     def mip_id(self):
         return self.miptable + '_' + self.cmor_label
 
-    @property
+    @cached_property
     def _priority_override(self):
-        result = False
+        result = None
         if self._notes:
-            result = self._MO_PRIORITY.search(self._notes)
+            result = _note_value(self._notes, self._MO_PRIORITY)
         return result
 
     @property
     def priort(self):
         priority = self.priority
-        if self._priority_override:
-            priority = self._priority_override.group(1)
+        if self._priority_override is not None:
+            priority = self._priority_override
         return int(priority)
 
-    @property
+    @cached_property
     def is_hadgem3(self):
         has_ukesm1_only_component = self.ukesm_component in ('chemistry', 'obgc')
-        has_section19 = len([x for x in self.stash_codes if 's19' in x]) > 0 
-        has_co2_ukesm1 = len([x for x in self.stash_codes 
+        has_section19 = len([x for x in self._stash_codes if 's19' in x]) > 0 
+        has_co2_ukesm1 = len([x for x in self._stash_codes 
                                  if x in ('m01s00i251', 'm01s00i252')]) > 0
 
         return not any((has_ukesm1_only_component,
@@ -271,21 +445,39 @@ class Request(namedtuple('Request', _FIELDS)):
                         has_co2_ukesm1))
             
 
-    @property
+    @cached_property
     def stash_codes_needed(self):
         result = None
-        if self.stash_codes:
-            result = ','.join(self.stash_codes)
+        if self._stash_codes:
+            result = ','.join(self._stash_codes)
         return result
 
     @property
     def stash_codes(self):
+        return list(self._stash_codes)
+
+    @cached_property
+    def _stash_codes(self): # cached, so kept immutable
         result = []
         if self._variable_mapping:
             result = stashlist_from_mapping_entry(self._variable_mapping)
-            if self._MODEL_LEVELS in self.dimension:
+            if result is None:  # not a usable mapping (already warned)
+                return ()
+            if self.dimension and self._MODEL_LEVELS in self.dimension:
                 result.append(self._OROG_STASH)
-        return result
+        return tuple(result)
+
+    @cached_property
+    def canon_cell_methods(self):
+        return canonical_cell_methods(self.cell_methods)
+
+    @cached_property
+    def canon_dims(self):
+        return tuple(sorted(_TIME_PATTERN.sub('time', self.dimension).split()))
+
+    @cached_property
+    def canon_frequency(self):
+        return self.frequency.replace('Pt', '')
 
     @property
     def inferred_plan(self):
@@ -293,57 +485,62 @@ class Request(namedtuple('Request', _FIELDS)):
 
     @property
     def groups(self):
+        return list(self._groups)
+
+    @cached_property
+    def _groups(self): # cached, so kept immutable
         grps = self.requestvargroup_membership_lists_of_mip_rvg_label
-        return str(grps).translate(None, '" ').split(',')  # sort out formatting
+        return tuple(_GROUP_PATTERN.findall(str(grps))) or ('',)
 
     @property
     def _notes(self): # add in a short hand
         return self.notes_this_doesnt_go_in_the_metadata
  
-    @property
+    @cached_property
     def _hadgem3_in_notes(self):
-        result = False
+        result = None
         if self._notes:
-            result = self._HADGEM3.search(self._notes)
+            result = _note_value(self._notes, self._HADGEM3)
         return result
 
-    @property
+    @cached_property
     def _variable_mapping(self):
         result = self.variable_mapping
-        if MODEL == 'HadGEM3' and self._hadgem3_in_notes:
-            result = self._hadgem3_in_notes.group(1)
+        if MODEL == 'HadGEM3' and self._hadgem3_in_notes is not None:
+            result = self._hadgem3_in_notes
         return result
 
-def _strip(val):
-    """
-    Strip surrounding whitespace if possible, otherwise return argument.
-
-    >>> _strip(' this thing ')
-    'this thing'
-
-    >>> _strip(10)
-    10
-    """
-    try:
-        result = val.strip()
-    except AttributeError:
-        result = val
-    return result
+# fields with few distinct values: share one string object between records
+_POOLED_FIELDS = ('miptable', 'cell_methods', 'dimension', 'units', 'realm',
+                  'priority', 'frequency', 'ukesm_component', 'plan',
+                  'cf_std_name', 'requesting_mips')
 
 class RecordReader(object):
     def __init__(self, entries):
         self._entries = entries
+        self._pool = {}
+        self._pooled = tuple(_FIELDS.index(field) for field in _POOLED_FIELDS)
         self._find_indexes()
 
     def __call__(self, row):
-        vals = (row[index].value for index in self._indices)
-        args = map(_strip, vals)
+        # strip surrounding whitespace from strings, leave other values alone
+        args = [val.strip() if isinstance(val, basestring) else val
+                for val in self._values(row)]
+        for index in self._pooled:
+            val = args[index]
+            if isinstance(val, basestring):
+                args[index] = self._pool.setdefault(val, val)
         return Request(*args)
         
     def _find_indexes(self):
-        self._indices = []
-        for title in _TITLES:
-            self._indices.append(self._entries.index(title))
+        positions = {}
+        for index, entry in enumerate(self._entries):
+            positions.setdefault(entry, index)  # first column wins, as with list.index
+        missing = [title for title in _TITLES if title not in positions]
+        if missing:
+            raise KeyError('columns missing from spreadsheet: {}'.format(missing))
+        self._indices = tuple(positions[title] for title in _TITLES)
+        self._values = itemgetter(*self._indices)
 
 def log_filter(func):
     """
@@ -374,6 +571,11 @@ def log_filter(func):
         return result
     return _logged
 
+_AVAILABLE_PLANS = frozenset(('available', 'post-process',
+                              'vn10.6',
+                              'vn10.6.1',
+                              'vn10.7'))
+
 def available(record):
     """
     Return True if the record is availiable.
@@ -392,10 +594,7 @@ def available(record):
     True
     """
     if record.inferred_plan != None:
-        return record.inferred_plan.strip() in ('available', 'post-process',
-                                                'vn10.6',
-                                                'vn10.6.1',
-                                                'vn10.7')
+        return record.inferred_plan.strip() in _AVAILABLE_PLANS
     else:
         return False
 
@@ -495,12 +694,20 @@ def compound_filter(*args):
         return all(afilter(record) for afilter in args)
     return filter
 
-include = compound_filter(available,
-                          good_freq,
-                          not_site,
-                          has_stash,
-                          hadgem3,
-                          not_rogue)
+def include(record):
+    """
+    Returns True if the record passes all the filters above.
+
+    Equivalent to compound_filter(available, good_freq, not_site, has_stash,
+    hadgem3, not_rogue), applying the filters in turn and stopping at the
+    first that fails.
+    """
+    return (available(record)
+            and good_freq(record)
+            and not_site(record)
+            and has_stash(record)
+            and hadgem3(record)
+            and not_rogue(record))
 
 def still_valid(row):
     """
@@ -508,41 +715,41 @@ def still_valid(row):
     """
     result = True
     return True  # FIXME
-    if not row[0].value: # removes empty rows - could be better
+    if not row[0]: # removes empty rows - could be better
         result = False
     else:
-        result = row[26].value == None or 'DELETE' not in row[26].value
+        result = row[26] == None or 'DELETE' not in row[26]
     return result
  
 class RequestWithMappings(object):
     def __init__(self, workbook, filt=True):
         self._sheet = workbook.get_sheet_by_name('Diagnostics')
-        self._rows = self._sheet.rows
+        self._rows = self._sheet.iter_rows(values_only=True)
         self.titles = self._titles()
         self._reader = RecordReader(self.titles)
         records = (self._reader(row) for row in self._rows if still_valid(row))
-        if filt:
-            self.records = filter(include, records)
-        else:
-            self.records = list(records)
+        self.records = [rec for rec in records if not filt or include(rec)]
+        self._by_table = defaultdict(list)
+        for rec in self.records:
+            self._by_table[rec.miptable].append(rec)
 
     def __iter__(self):
         return iter(self.records)
 
     def _titles(self):
-        result = map(attrgetter('value'), next(self._rows))
+        result = list(next(self._rows))
         if not result[0]:  # for some reason the reading returns None?
             result[0] = 'cmor_label'
         return result
 
     def _records_for_table(self, table):
-        return [rec for rec in self.records if rec.miptable == table]
+        return list(self._by_table.get(table, ()))
 
     def tables(self):
-        return [Table(table, self._records_for_table(table)) for table in self.table_names()]
+        return [Table(table, list(records)) for table, records in sorted(self._by_table.items())]
 
     def table_names(self):
-        return tuple(sorted(set(rec.miptable for rec in self.records)))
+        return tuple(sorted(self._by_table))
         
     # this is maintained for consistency - not sure it is really necessary
     def first_table_dim(self):
@@ -7,12 +7,12 @@ import sys
 sys.path.append('.')
 import operator
 import itertools
-import re
+from collections import defaultdict
 
 import cmip6_gdoc
 
-dreq = cmip6_gdoc.open('./data/CMIP6_datareq_UKESM_mappings_161117_1141_updated.xlsx', filt=False)
-dold = cmip6_gdoc.open('./data/CMIP6_datareq_UKESM_mappings.xlsx', filt=False)
+dreq = cmip6_gdoc.open('./data/CMIP6_datareq_UKESM_mappings_161117_1141_updated.xlsx', filt=False, cache=True)
+dold = cmip6_gdoc.open('./data/CMIP6_datareq_UKESM_mappings.xlsx', filt=False, cache=True)
 
 # In[3]:
 
@@ -35,45 +35,46 @@ def mip_id(a):
     return str(a.mip_id)
 
 def clean_cell_methods(a):
-    return re.sub('\(comment:.*\)', '(comment:..)', str(a))
+    return cmip6_gdoc.canonical_cell_methods(a)
 
-def _clean_dims(dim):
-    d = re.sub('time\d+', 'time', dim)
-    return sorted(d.split())
+def _move_keys(rec):
+    """
+    Returns the keys used to match an added record to a removed one.
 
-def _clean_freq(freq):
-    return re.sub('Pt', '', freq)
-
-def is_move(a, b):
-    same_cell = clean_cell_methods(a.cell_methods) == clean_cell_methods(b.cell_methods)
-    same_dims = _clean_dims(a.dimension) == _clean_dims(b.dimension)
-    same_name = a.cf_std_name == b.cf_std_name or a.title == b.title
-    same_freq = _clean_freq(a.frequency) == _clean_freq(b.frequency)
-    return all((same_cell, same_dims, same_name, same_freq))
+    Two records are a move if their canonical cell methods, dimensions and
+    frequency agree and they share either the cf_std_name or the title,
+    i.e. if any of their keys are equal.
+    """
+    common = (rec.canon_cell_methods, rec.canon_dims, rec.canon_frequency)
+    return (common + ('cf_std_name', rec.cf_std_name),
+            common + ('title', rec.title))
 
 def find_moves(adds, dels):
+    dels_by_key = defaultdict(list)
+    for i, d in enumerate(dels):
+        for key in _move_keys(d):
+            dels_by_key[key].append(i)
+
     moves = []
     for a in adds:
-        for d in dels:
-            if is_move(a, d):
-                moves.append((a, d))
+        matches = set()
+        for key in _move_keys(a):
+            matches.update(dels_by_key.get(key, ()))
+        moves.extend((a, dels[i]) for i in sorted(matches))
     return moves
 
-def _from_moves(moves, ind):
-    return [move[ind] for move in moves]
-
 def identify_moves(adds, dels):
     moves = find_moves(adds, dels)
 
-    real_adds = filter(lambda x: x not in _from_moves(moves, 0), adds)
-    real_dels = filter(lambda x: x not in _from_moves(moves, 1), dels)
+    moved_adds = {id(move[0]) for move in moves}
+    moved_dels = {id(move[1]) for move in moves}
+    real_adds = [x for x in adds if id(x) not in moved_adds]
+    real_dels = [x for x in dels if id(x) not in moved_dels]
 
     return moves, real_adds, real_dels
 
 def same(a): return a
 
-def clean_cell_methods(a): return re.sub('\(comment:.*\)', '(comment:..)', str(a))
-
 def clean_units(a):
     try:
         result = float(str(a))
@@ -94,10 +95,10 @@ def cmp_records(r1, r2):
     """Returns dictionary comparing elements of namedtuple."""
     result = dict()
     for field, func in CMPS.iteritems():
-        val1 = getattr(r1, field)
-        val2 = getattr(r2, field)
-        if func(val1) != func(val2):
-            result[field] = (func(val1), func(val2))
+        val1 = func(getattr(r1, field))
+        val2 = func(getattr(r2, field))
+        if val1 != val2:
+            result[field] = (val1, val2)
     return result
 
 def records_diffs(v1, v2):
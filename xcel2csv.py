@@ -1,38 +1,33 @@
 #!/usr/bin/env python
 
 import sys
-from operator import attrgetter
+import csv
 from openpyxl import load_workbook
-from toolz.functoolz import compose
 
-value = attrgetter('value')
-def format_row(row, sep=', '):
-    """Return row as 'sep' separated string."""
-    format_item = compose(str, value)
-    return sep.join(map(format_item, row))
+BUFFER_SIZE = 1 << 20
 
-def debug_row(row):
-    """Some rows are corrupt - do best to print them out."""
-    for i in row:
-        print value(i)
+def format_value(value):
+    """Return value ready for the csv writer: utf-8 encoded, None as empty."""
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
 
-def rows_in_workbook(file):
+def rows_in_workbook(ifile):
     """Return iterator over rows of the first sheet in ifile."""
     wb = load_workbook(ifile)
-    return wb.active.iter_rows()
+    return wb.active.iter_rows(values_only=True)
 
 def copy_to_csv(ifile, fo): 
     """Copy spreadsheet ifile to file object fo as csv."""
+    writer = csv.writer(fo)
     for row in rows_in_workbook(ifile):
-        try:
-            fo.write(format_row(row) + '\n')
-        except UnicodeEncodeError:
-            debug_row(row)
-            break
+        writer.writerow([format_value(value) for value in row])
    
 ifile = sys.argv[1]
 ofile = ifile + '.csv'
 
-with open(ofile, 'w') as fo:
+with open(ofile, 'wb', BUFFER_SIZE) as fo:
     copy_to_csv(ifile, fo)
     